@@ -11,7 +11,7 @@ COMFY_PATH = Path("/home/user/ComfyUI")
 OUTPUT_DIRECTORY = COMFY_PATH / "output"
 INPUT_DIRECTORY = COMFY_PATH / "input"
 SERVER_URL = "http://localhost"
-MAX_CONNECT_ATTEMPTS = 25  # Increase for slow systems
+MAX_CONNECT_ATTEMPTS = 55  # Increase for slow systems
 WORKFLOW_NAME = "my_workflow"
 WORKFLOW_TEMPLATE_PATH = COMFY_PATH / "workflows" / "template.json"
 
@@ -26,6 +26,8 @@ def main():
         port=8188,
         log_level=logging.DEBUG,
     )
+    # Start the server first so it boots while the workflow and client are set up
+    server.start()
     client = ComfyClient(
         workflow=ComfyAPIWorkflow(
             workflow_template_path=WORKFLOW_TEMPLATE_PATH,
@@ -36,12 +38,11 @@ def main():
         port=8188,
         log_level=logging.DEBUG,
     )
-    server.start()
     client.connect()
 
     client.queue_workflow()
 
-    client.disconnect()
+    client.close()
     server.kill()
 
 
@@ -1,21 +1,53 @@
-import json
-from urllib import request
-import uuid
+import atexit
+import gzip
+import http.client
+import os
+import queue
+import socket
+from urllib.parse import urlparse
 from pathlib import Path
 import time
 import logging
+from logging.handlers import QueueHandler, QueueListener
 
 try:
-    import websocket
+    import orjson
 except ImportError as e:
     print(
-        "Please install the websocket-client package using",
-        "'pip install websocket-client'",
-        "or 'python3 -m pip install websocket-client'",
+        "Please install the orjson package using",
+        "'pip install orjson'",
+        "or 'python3 -m pip install orjson'",
     )
     raise e
 
 
+PROGRESS_LOG_INTERVAL = 0.2  # Seconds between logged progress messages
+CONNECT_TIMEOUT = 1  # Seconds, long enough for remote servers
+COMPRESSION_THRESHOLD = 1400  # Bytes, roughly one TCP segment
+LOOPBACK_HOSTS = ("localhost", "127.0.0.1", "::1")
+
+
+class CachedTimeFormatter(logging.Formatter):
+    """
+    A logging.Formatter that formats the timestamp at most once per second, reusing it for
+    every other record created within the same second.
+
+    Only use with date formats that have at most one-second resolution (e.g., "%H:%M:%S").
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__cached_second = -1
+        self.__cached_time = ""
+
+    def formatTime(self, record, datefmt=None):
+        second = int(record.created)
+        if second != self.__cached_second:
+            self.__cached_time = super().formatTime(record, datefmt)
+            self.__cached_second = second
+        return self.__cached_time
+
+
 class ComfyClient:
     """
     Represents a client for interacting with the Comfy server using a WebSocket connection.
@@ -23,9 +55,9 @@ class ComfyClient:
     See: https://github.com/comfyanonymous/ComfyUI/blob/master/script_examples/websockets_api_example.py
 
     Args:
-      workflow (Workflow): The workflow object representing the desired workflow to be executed. Required methods are get_workflow_dict() for returning the workflow json data as a dict and parse_node_name().
+      workflow (Workflow): The workflow object representing the desired workflow to be executed. Required methods are get_workflow_dict() for returning the workflow json data as a dict and parse_node_name(). If it also has a version attribute, the encoded request is reused between queues until the version changes, so the workflow must change its version on every edit (ComfyAPIWorkflow does this in update(), but not for direct edits to its workflow_dict).
       server_url (str): The URL of the Comfy server. Defaults to "http://localhost".
-      max_connect_attempts (int, optional): The maximum number of connection attempts to the Comfy server. Defaults to 10.
+      max_connect_attempts (int, optional): The maximum number of connection attempts to the Comfy server. Attempts back off exponentially from 20ms up to 500ms apart. Defaults to 25.
       port (int, optional): The port number to connect to the Comfy server. Defaults to 8188.
 
     Attributes:
@@ -36,6 +68,7 @@ class ComfyClient:
     Methods:
       connect: Connects to the Comfy server using a WebSocket connection.
       disconnect: Disconnects from the Comfy server by closing the WebSocket connection.
+      close: Disconnects and releases the client's background logging thread and log file.
       queue_workflow: Queues a workflow by sending a request to the Comfy API server and waits for it to complete.
     """
 
@@ -43,7 +76,7 @@ class ComfyClient:
         self,
         workflow,
         server_url: str = "http://localhost",
-        max_connect_attempts: int = 10,
+        max_connect_attempts: int = 25,
         port: int = 8188,
         log_level: int = logging.DEBUG,
     ):
@@ -59,12 +92,42 @@ class ComfyClient:
         else:
             self.websock_url = f"ws://{self.server_url}"
 
-        self.client_id = str(uuid.uuid4())
-        self.client_id_truncated = self.client_id.split("-")[0]
-        self.__websocket = None
+        self.__host = urlparse(self.websock_url).hostname
+
+        # Kept alive for the lifetime of the client so repeated queues reuse the TCP connection
+        http_connection = (
+            http.client.HTTPSConnection
+            if self.server_url.startswith("https")
+            else http.client.HTTPConnection
+        )
+        self.__http = http_connection(self.__host, port)
+        # Compressing is only worth it when the payload actually crosses a network
+        self.__compress_requests = self.__host not in LOOPBACK_HOSTS
 
-        self.logger = logging.getLogger("Client")
+        self.client_id = os.urandom(16).hex()
+        self.client_id_truncated = self.client_id[:8]
+        self.__ws_endpoint = f"{self.websock_url}/ws?clientId={self.client_id}"
+        self.__websocket = None
+        self.__payload_cache = None
+        self.__payload_version = None
+        # ComfyUI serializes messages with json.dumps, which puts a space after the colon
+        self.__progress_marker = b'"type": "progress"'
+        self.__executing_marker = b'"type": "executing"'
+        # Anchored to the start of the data object so keys like "display_node": null don't match
+        self.__node_done_marker = b'"data": {"node": null'
+        self.__prompt_id_marker = None
+        self.__last_progress_log = 0.0
+        self.__pending_progress = None
+        self.__dispatch = {
+            "status": self.__on_status,
+            "progress": self.__on_progress,
+            "executing": self.__on_executing,
+        }
+
+        # One logger per instance, so creating more instances doesn't duplicate every record
+        self.logger = logging.getLogger(f"Client.{self.client_id_truncated}")
         self.logger.setLevel(log_level)
+        self.logger.propagate = False
         self.__setup_logging()
         self.logger.info(
             f"New Comfy Client Created at {time.strftime('%Y-%m-%d_%H:%M:%S')}\n"
@@ -77,46 +140,78 @@ class ComfyClient:
         Returns:
             bool: True if the client is connected.
         """
-        return self.__websocket is not None and self.__websocket.connected
+        if self.__websocket is None:
+            return False
+        # Already imported by connect(), which created the websocket
+        from websockets.protocol import State
+
+        return self.__websocket.protocol.state is State.OPEN
 
     def connect(self):
         """
         Connects to the Comfy server using a WebSocket connection.
-        Attempts to connect to the server every second, MAX_CONNECT_ATTEMPTS
-        times.
+        Attempts to connect to the server MAX_CONNECT_ATTEMPTS times, backing
+        off exponentially from 20ms to 500ms between attempts.
 
         This is done because Comfy may take a long time to start up, but
-        we don't want to wait any longer than necessary.
+        we don't want to wait any longer than necessary. The WebSocket
+        handshake is only attempted once the server's port accepts connections.
 
         Raises:
             ConnectionError: If the connection to the Comfy server fails.
         """
-        self.__websocket = websocket.WebSocket()
+        try:
+            from websockets.exceptions import InvalidHandshake
+            from websockets.sync.client import connect as ws_connect
+        except ImportError as e:
+            print(
+                "Please install the websockets package using",
+                "'pip install websockets'",
+                "or 'python3 -m pip install websockets'",
+            )
+            raise e
+
+        self.__start_log_listener()
 
+        delay = 0.02
         for attempt in range(self.max_connect_attempts):
+            if not self.__port_open():
+                self.logger.debug(
+                    f"Connection Attempt {attempt + 1}/{self.max_connect_attempts}: Failed - Port {self.port} Closed"
+                )
+                time.sleep(delay)
+                delay = min(delay * 2, 0.5)
+                continue
+
             try:
-                self.__websocket.connect(
-                    f"{self.websock_url}/ws?clientId={self.client_id}",
+                # Compression is disabled since the server is usually local and
+                # previews can be larger than the default max message size
+                self.__websocket = ws_connect(
+                    self.__ws_endpoint,
+                    compression=None,
+                    max_size=None,
+                    open_timeout=CONNECT_TIMEOUT,
                 )
-            except ConnectionRefusedError:
+            except (ConnectionRefusedError, InvalidHandshake, TimeoutError) as e:
                 self.logger.debug(
-                    f"Connection Attempt {attempt + 1}/{self.max_connect_attempts}: Failed - Connection Refused"
+                    f"Connection Attempt {attempt + 1}/{self.max_connect_attempts}: Failed - {e}"
                 )
-                time.sleep(1)
+                time.sleep(delay)
+                delay = min(delay * 2, 0.5)
                 continue
 
-            if self.__websocket.connected:
-                self.logger.info(
-                    f"Connection Attempt {attempt + 1}/{self.max_connect_attempts}: Succeeded - Connection Established\n"
-                )
-                break
+            self.logger.info(
+                f"Connection Attempt {attempt + 1}/{self.max_connect_attempts}: Succeeded - Connection Established\n"
+            )
+            break
 
-        if not self.__websocket.connected:
+        if not self.is_connected():
             raise ConnectionError("Failed to connect to Comfy server")
 
     def disconnect(self):
         """
-        Disconnects from the Comfy server by closing the WebSocket connection.
+        Disconnects from the Comfy server by closing the WebSocket and HTTP connections.
+        Pending log records are flushed before returning.
 
         Returns:
             None
@@ -128,6 +223,21 @@ class ComfyClient:
             self.logger.info(
                 "Disconnect Client Attempt: Client is already disconnected\n"
             )
+        self.__http.close()
+        self.__stop_log_listener()
+
+    def close(self):
+        """
+        Disconnects from the Comfy server, then stops the client's background logging thread and
+        closes its log file. Call this when done with the client, e.g., when creating many clients in a batch.
+
+        Returns:
+            None
+        """
+        self.disconnect()
+        atexit.unregister(self.__stop_log_listener)
+        self.logger.removeHandler(self.__queue_handler)
+        self.__filehandler.close()
 
     def queue_workflow(self):
         """
@@ -145,15 +255,14 @@ class ComfyClient:
             self.connect()
 
         try:
-            start_time_epoch = time.time()
+            start_time = time.monotonic()
             self.logger.info(f"Queueing Workflow at: {time.strftime('%I:%M%p')}")
 
             self.__send_request()
             self.__listen_until_complete()
 
-            time_diff_formatted = time.strftime(
-                "%Mmin, %Ssec", time.gmtime(time.time() - start_time_epoch)
-            )
+            minutes, seconds = divmod(int(time.monotonic() - start_time), 60)
+            time_diff_formatted = f"{minutes:02d}min, {seconds:02d}sec"
             self.logger.info(
                 f"ComfyUI Server finished processing request at: {time.strftime('%I:%M%p')} (Time elapsed - {time_diff_formatted})"
             )
@@ -164,60 +273,156 @@ class ComfyClient:
         finally:
             self.__websocket.close()
 
+    def __port_open(self):
+        """
+        Cheap readiness probe that checks whether the server accepts TCP connections.
+        A closed local port is refused immediately, so the timeout only matters for remote servers.
+
+        Returns:
+            bool: True if the server's port is open.
+        """
+        try:
+            with socket.create_connection((self.__host, self.port), timeout=CONNECT_TIMEOUT):
+                return True
+        except OSError:
+            return False
+
     def __get_request_data(self):
-        return json.dumps(
+        """
+        Encodes the /prompt request body, gzip-compressing it when sent to a remote server.
+        The result is reused until the workflow's version changes.
+
+        Returns:
+            tuple: The request body (bytes) and its headers (dict).
+        """
+        version = getattr(self.workflow, "version", None)
+        if version is not None and version == self.__payload_version:
+            return self.__payload_cache
+
+        body = orjson.dumps(
             {"prompt": self.workflow.get_workflow_dict(), "client_id": self.client_id}
-        ).encode("utf-8")
+        )
+        headers = {"Content-Type": "application/json"}
+        if self.__compress_requests and len(body) > COMPRESSION_THRESHOLD:
+            # ComfyUI's aiohttp server decodes gzip request bodies transparently
+            body = gzip.compress(body, compresslevel=1)
+            headers["Content-Encoding"] = "gzip"
+
+        self.__payload_cache = (body, headers)
+        self.__payload_version = version
+        return self.__payload_cache
 
     def __send_request(self):
-        req = request.Request(
-            str(self.server_url) + "/prompt", data=self.__get_request_data()
-        )
-        resp = json.loads(request.urlopen(req).read())
+        try:
+            resp = self.__post_prompt()
+        except (ConnectionResetError, BrokenPipeError):
+            # The server dropped the idle keep-alive connection - reconnect and retry once
+            self.__http.close()
+            resp = self.__post_prompt()
         self.response_prompt_id = resp["prompt_id"]
+        self.__prompt_id_marker = f'"prompt_id": "{self.response_prompt_id}"'.encode()
+
+    def __post_prompt(self):
+        body, headers = self.__get_request_data()
+        self.__http.request("POST", "/prompt", body=body, headers=headers)
+        response = self.__http.getresponse()
+        response_body = response.read()
+        if response.status != 200:
+            # e.g., 400 with the validation error and node_errors for an invalid prompt
+            raise RuntimeError(
+                f"Comfy server rejected the workflow ({response.status} {response.reason}): "
+                + response_body.decode("utf-8", errors="replace")
+            )
+        return orjson.loads(response_body)
 
     def __handle_response_message(self, message):
-        if message["type"] == "status":
-            self.logger.debug(message["data"]["status"])
-        elif message["type"] == "progress":
-            # Can add progress bar printing here
-            pass
-        elif message["type"] == "executing":
-            cur_node_name = self.workflow.parse_node_name(message["data"])
-            self.logger.info(f"Executing Node: {cur_node_name}")
+        handler = self.__dispatch.get(message["type"])
+        return handler(message["data"]) if handler else False
 
-            if (
-                message["data"]["node"] is None
-                and message["data"]["prompt_id"] == self.response_prompt_id
-            ):
-                return True  # Execution is done
-        return False  # Previews are binary data
+    def __on_status(self, data):
+        self.logger.debug(data["status"])
+        return False
+
+    def __on_progress(self, data):
+        # Can add progress bar printing here
+        self.__last_progress_log = time.monotonic()
+        self.logger.debug(f"Progress: {data['value']}/{data['max']}")
+        return False
+
+    def __on_executing(self, data):
+        cur_node_name = self.workflow.parse_node_name(data)
+        self.logger.info(f"Executing Node: {cur_node_name}")
+
+        # Execution is done
+        return data["node"] is None and data["prompt_id"] == self.response_prompt_id
 
     def __listen_until_complete(self):
         while True:
-            out = self.__websocket.recv()
-            if isinstance(out, str):
-                message = json.loads(out)
-                if self.__handle_response_message(message):
-                    break
+            out = self.__websocket.recv(decode=False)
+            # Previews are binary data (prefixed with an event type int, not a JSON object)
+            if out[:1] != b"{":
+                continue
+            # Progress messages arrive once per sampler step, so within each interval only
+            # the latest one is kept, and it is parsed once the interval is over or another
+            # kind of message (e.g., the next node executing) arrives
+            if self.__progress_marker in out[:64]:
+                if time.monotonic() - self.__last_progress_log < PROGRESS_LOG_INTERVAL:
+                    self.__pending_progress = out
+                    continue
+                self.__pending_progress = None
+            else:
+                self.__flush_pending_progress()
+            # The only message that ends execution is checked without parsing it
+            if (
+                self.__executing_marker in out[:64]
+                and self.__node_done_marker in out
+                and self.__prompt_id_marker in out
+            ):
+                break
+            if self.__handle_response_message(orjson.loads(out)):
+                break
+
+    def __flush_pending_progress(self):
+        if self.__pending_progress is not None:
+            pending, self.__pending_progress = self.__pending_progress, None
+            self.__handle_response_message(orjson.loads(pending))
 
     def __setup_logging(self):
         self.logfile_path = (
             (Path(__file__).parent.parent)
             / "logs"
-            / f"comfy_client_{time.strftime('%Y-%m-%d_%H:%M:%S')}.log"
+            / f"comfy_client_{time.strftime('%Y-%m-%dT%H-%M-%S')}.log"
         )
         self.logfile_path.parent.mkdir(parents=True, exist_ok=True)
-        formatter = logging.Formatter(
+        formatter = CachedTimeFormatter(
             "[%(asctime)s] [%(levelname)s]"
             + f" [Client {self.client_id_truncated}] "
             + "%(message)s",
             datefmt="%H:%M:%S",
         )
-        filehandler = logging.FileHandler(self.logfile_path)
-        filehandler.setFormatter(formatter)
-        self.logger.addHandler(filehandler)
+        self.__filehandler = logging.FileHandler(self.logfile_path)
+        self.__filehandler.setFormatter(formatter)
 
         streamhandler = logging.StreamHandler()
         streamhandler.setFormatter(formatter)
-        self.logger.addHandler(streamhandler)
+
+        # Records are written by a background thread so the receive loop never blocks on I/O
+        log_queue = queue.SimpleQueue()
+        self.__queue_handler = QueueHandler(log_queue)
+        self.logger.addHandler(self.__queue_handler)
+        self.__log_listener = QueueListener(
+            log_queue, self.__filehandler, streamhandler
+        )
+        self.__log_listener_running = False
+        self.__start_log_listener()
+        atexit.register(self.__stop_log_listener)
+
+    def __start_log_listener(self):
+        if not self.__log_listener_running:
+            self.__log_listener.start()
+            self.__log_listener_running = True
+
+    def __stop_log_listener(self):
+        if self.__log_listener_running:
+            self.__log_listener.stop()
+            self.__log_listener_running = False
@@ -1,8 +1,18 @@
+import atexit
+import http.client
+import os
+import queue
+import signal
+import socket
 import subprocess
-from urllib import request, error
+from urllib.parse import urlparse
 from pathlib import Path
 import time
 import logging
+from logging.handlers import QueueHandler, QueueListener
+
+
+TERMINATE_TIMEOUT = 5  # Seconds to wait for the server to exit before killing it
 
 
 class ComfyServer:
@@ -44,17 +54,40 @@ class ComfyServer:
         self.port = port
 
         self.server_url = f"{server_url}:{port}"
+        self.__host = urlparse(self.server_url).hostname
+        # Kept alive so repeated probes of the server reuse the TCP connection
+        http_connection = (
+            http.client.HTTPSConnection
+            if self.server_url.startswith("https")
+            else http.client.HTTPConnection
+        )
+        self.__http = http_connection(self.__host, port, timeout=0.25)
         self.server_process = None
-        self.log_stream = None
         self.pid = None
         self.__comfy_launcher_target = comfy_path / "main.py"
+        # See all available arguments in the Comfy CLI documentation:
+        # https://github.com/comfyanonymous/ComfyUI/blob/master/comfy/cli_args.py
+        self.__cli_args = [
+            str(self.python_path),
+            str(self.__comfy_launcher_target),
+            "--port",
+            str(self.port),
+            "--output-directory",
+            str(self.output_directory),
+            "--input-directory",
+            str(self.input_directory),
+            "--disable-auto-launch",
+            "--disable-metadata",
+        ]
 
-        self.logger = logging.getLogger("Server")
+        # One logger per instance, so creating more instances doesn't duplicate every record
+        self.logger = logging.getLogger(f"Server.{port}.{id(self):x}")
         self.logger.setLevel(log_level)
+        self.logger.propagate = False
         self.__setup_logging()
         self.logger.debug(
-            "This is the command that will be used to start the ComfyUI server process:\n"
-            + f"{' '.join(self.__get_comfy_cli_args())}\n"
+            "This is the command that will be used to start the ComfyUI server process:\n%s\n",
+            " ".join(self.__cli_args),
         )
 
     def start(self):
@@ -71,6 +104,7 @@ class ComfyServer:
         Returns:
           None
         """
+        self.__start_log_listener()
         try:
             self.__launch_process()
             self.logger.info(
@@ -83,59 +117,70 @@ class ComfyServer:
     def kill(self):
         """
         Terminates the server process and waits for it to finish.
-        Closes the log stream.
+        Pending log records are flushed to the log file before returning.
 
         If the server process exists, it will be terminated and the method will wait
-        for the process to finish. If the server process does not exist, a log message
-        will be printed indicating that there is no server to stop.
+        for the process to finish. If it hasn't exited after TERMINATE_TIMEOUT seconds
+        (e.g., stuck releasing the GPU), its whole process group is killed. If the server
+        process does not exist, a log message will be printed indicating that there is
+        no server to stop.
         """
         if self.server_process:
             self.server_process.terminate()
-            self.server_process.wait()
-            log_msg = "Server stopped"
+            try:
+                self.server_process.wait(timeout=TERMINATE_TIMEOUT)
+                log_msg = "Server stopped"
+            except subprocess.TimeoutExpired:
+                # The server was started in its own session, so its pid is also its process group id
+                try:
+                    os.killpg(self.server_process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass  # The whole group exited after the timeout
+                self.server_process.wait()
+                log_msg = f"Server did not stop after {TERMINATE_TIMEOUT}s - Killed"
         else:
             log_msg = "Disconnect Attempt: No ComfyUI server process to kill"
-        # Close the log stream before logging from separate process
-        self.__close_log_stream()
+        self.__http.close()
         self.logger.info(self.__prefix_log_msg(log_msg))
+        self.__stop_log_listener()
 
-    def __get_comfy_cli_args(self):
+    def __open_log_fd(self):
         """
-        Get the command-line arguments for running the Comfy CLI.
-        See all available arguments in the Comfy CLI documentation:
-        https://github.com/comfyanonymous/ComfyUI/blob/master/comfy/cli_args.py
+        Opens the log file for the server process with O_APPEND, so writes from the server
+        process and from this process's logger are each appended atomically.
 
         Returns:
-          list: A list of command-line arguments.
+          int: The file descriptor of the log file.
         """
-        return [
-            str(self.python_path),
-            str(self.__comfy_launcher_target),
-            "--port",
-            str(self.port),
-            "--output-directory",
-            str(self.output_directory),
-            "--input-directory",
-            str(self.input_directory),
-            "--disable-auto-launch",
-            "--disable-metadata",
-        ]
+        return os.open(
+            str(self.__logfile_path), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644
+        )
 
-    def __set_log_stream(self):
+    def __server_running(self):
         """
+        Checks if a server is already running by making a HEAD request to the server URL
+        over the kept-alive HTTP connection.
+
+        No server is the common case, so when there is no open connection yet, a bare TCP
+        connect is tried first and a refused connection is taken as the answer.
+
         Returns:
-          File: The log file stream.
+          bool: True if the server responded with 200 OK.
         """
-        self.log_stream = open(str(self.__logfile_path), "a")
-        return self.log_stream
+        if self.__http.sock is None:
+            try:
+                socket.create_connection((self.__host, self.port), timeout=0.1).close()
+            except OSError:
+                return False
 
-    def __close_log_stream(self):
-        if (
-            self.log_stream
-            and "closed" in dir(self.log_stream)
-            and not self.log_stream.closed
-        ):
-            self.log_stream.close()
+        try:
+            self.__http.request("HEAD", "/")
+            response = self.__http.getresponse()
+            response.read()
+            return response.status == 200
+        except (OSError, http.client.HTTPException):
+            self.__http.close()
+            return False
 
     def __launch_process(self):
         """
@@ -149,25 +194,28 @@ class ComfyServer:
         Returns:
           None
         """
-        try:
-            with request.urlopen(self.server_url) as f:
-                if f.status == 200:
-                    self.logger.warning(
-                        f"Server already running on port {self.port} - Connecting"
-                    )
-                    return
-        except (error.URLError, error.HTTPError, KeyError):
-            self.logger.info(
-                f"No existing server on port {self.port}. Starting detached server process"
+        if self.__server_running():
+            self.logger.warning(
+                f"Server already running on port {self.port} - Connecting"
             )
-
-        log = self.__set_log_stream()
-        self.server_process = subprocess.Popen(
-            self.__get_comfy_cli_args(),
-            stderr=log,
-            stdout=log,
-            start_new_session=True,
+            return
+        self.logger.info(
+            f"No existing server on port {self.port}. Starting detached server process"
         )
+
+        log_fd = self.__open_log_fd()
+        try:
+            # Popen spawns with vfork() on Linux (Python 3.10+), so the parent's memory is
+            # not copied even when it is a large, long-running batch process
+            self.server_process = subprocess.Popen(
+                self.__cli_args,
+                stderr=log_fd,
+                stdout=log_fd,
+                start_new_session=True,
+            )
+        finally:
+            # The server process has its own copy of the descriptor
+            os.close(log_fd)
         self.pid = self.server_process.pid
 
     def __prefix_log_msg(self, *args):
@@ -176,14 +224,14 @@ class ComfyServer:
           *args: The message to log.
           **kwargs: Additional keyword arguments to pass to the logging function.
         """
-        prefix = f"[Server {self.pid}] " if self.pid else "[Server Idle] "
-        return prefix + " ".join(map(str, args))
+        prefix = f"[Server {self.pid}]" if self.pid else "[Server Idle]"
+        return " ".join([prefix, *map(str, args)])
 
     def __setup_logging(self):
         self.__logfile_path = (
             (Path(__file__).parent.parent)
             / "logs"
-            / f"comfy_server_{time.strftime('%Y-%m-%d_%H:%M:%S')}.log"
+            / f"comfy_server_{time.strftime('%Y-%m-%dT%H-%M-%S')}.log"
         )
         self.__logfile_path.parent.mkdir(parents=True, exist_ok=True)
         formatter = logging.Formatter(
@@ -192,8 +240,26 @@ class ComfyServer:
         )
         filehandler = logging.FileHandler(self.__logfile_path)
         filehandler.setFormatter(formatter)
-        self.logger.addHandler(filehandler)
 
         streamhandler = logging.StreamHandler()
         streamhandler.setFormatter(formatter)
-        self.logger.addHandler(streamhandler)
+
+        # Records are handled by a background thread so logging never blocks on I/O
+        log_queue = queue.SimpleQueue()
+        self.logger.addHandler(QueueHandler(log_queue))
+        # Not buffered beyond the queue, since the server process writes to the same file
+        # and records must land in order with its output
+        self.__log_listener = QueueListener(log_queue, filehandler, streamhandler)
+        self.__log_listener_running = False
+        self.__start_log_listener()
+        atexit.register(self.__stop_log_listener)
+
+    def __start_log_listener(self):
+        if not self.__log_listener_running:
+            self.__log_listener.start()
+            self.__log_listener_running = True
+
+    def __stop_log_listener(self):
+        if self.__log_listener_running:
+            self.__log_listener.stop()
+            self.__log_listener_running = False
@@ -1,7 +1,24 @@
-import json
+import atexit
+import os
+import queue
+import threading
 from pathlib import Path
 import time
 import logging
+from logging.handlers import MemoryHandler, QueueHandler, QueueListener
+
+try:
+    import orjson
+except ImportError as e:
+    print(
+        "Please install the orjson package using",
+        "'pip install orjson'",
+        "or 'python3 -m pip install orjson'",
+    )
+    raise e
+
+
+SAVE_DEBOUNCE_INTERVAL = 0.25  # Seconds to collect save_after updates into one write
 
 
 class ComfyAPIWorkflow:
@@ -10,6 +27,7 @@ class ComfyAPIWorkflow:
         workflow_template_path: Path,
         name: str = "copy",
         log_level: int = logging.DEBUG,
+        pretty: bool = False,
     ):
         """
         Initializes a ComfyAPIWorkflow instance. The workflow should be a JSON file that was saved using
@@ -19,16 +37,22 @@ class ComfyAPIWorkflow:
           workflow_template_path (Path): The path to the workflow template JSON file (API version).
           name (str): The name of the workflow, if saving a new version to disk. Defaults to "copy".
           log_level (int, optional): The logging level (verbosity). Defaults to logging.DEBUG.
+          pretty (bool, optional): Whether to indent the saved workflow file for readability.
+            Comfy doesn't need it, so files are saved compact by default. Defaults to False.
 
         Attributes:
           filename (str): The name of the workflow file.
           workflows_dir (Path): The directory where the workflow files are located.
           path (Path): The full path to the workflow file.
-          workflow_dict (dict): The workflow data.
+          workflow_dict (dict): The workflow data. Prefer update() over editing it directly.
+          version (int): Incremented by update(). ComfyClient reuses its encoded request until this
+            changes, so increment it yourself after editing workflow_dict directly.
 
         Methods:
           save: Saves a new copy of the workflow as a json file in the same directory as the template.
           update: Update one of the inputs of a node in the workflow dict.
+          flush: Immediately writes updates that are waiting to be saved.
+          close: Stops the workflow's background logging and closes its log file.
           get_workflow_dict: Returns the workflow as a dict.
           parse_node_name: Accepts the data dict from a response from the comfy server and returns the name of the node that the data is about.
 
@@ -37,19 +61,28 @@ class ComfyAPIWorkflow:
         """
         self.workflow_template_path = workflow_template_path
         self.name = name
+        self.pretty = pretty
 
         self.filename = (
             workflow_template_path.name.replace(".json", "") + f"-{self.name}.json"
         )
         self.workflows_dir = workflow_template_path.parent
         self.path = self.workflows_dir / self.filename
+        self.version = 0
+        self.__dirty = False
+        self.__save_timer = None
+        self.__save_lock = threading.Lock()
+        self.__write_lock = threading.Lock()
 
         self.__set_workflow()
         self.__set_node_mappings()
         self.save()
+        atexit.register(self.flush)
 
-        self.logger = logging.getLogger("Workflow")
+        # One logger per instance, so creating more instances doesn't duplicate every record
+        self.logger = logging.getLogger(f"Workflow.{self.name}.{id(self):x}")
         self.logger.setLevel(log_level)
+        self.logger.propagate = False
         self.__setup_logging()
         self.logger.info(
             f"Created Copy of Workflow Template in {self.workflow_template_path.parent}\n"
@@ -58,9 +91,41 @@ class ComfyAPIWorkflow:
     def save(self):
         """
         Saves the workflow dictionary to the workflow file.
+
+        The file is replaced atomically, so readers and concurrent saves (e.g., from the
+        debounced save timer) never see a partially written file.
+        """
+        option = orjson.OPT_INDENT_2 if self.pretty else None
+        data = orjson.dumps(self.workflow_dict, option=option)
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with self.__write_lock:
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, self.path)
+
+    def flush(self):
+        """
+        Immediately saves the workflow if updates made with save_after=True are waiting to be saved.
         """
-        with open(self.path, "w") as workflow_file:
-            json.dump(self.workflow_dict, workflow_file, indent=4)
+        with self.__save_lock:
+            if self.__save_timer is not None:
+                self.__save_timer.cancel()
+                self.__save_timer = None
+            dirty, self.__dirty = self.__dirty, False
+        if dirty:
+            self.save()
+
+    def close(self):
+        """
+        Writes any pending save, stops the workflow's background logging thread and closes its
+        log file. Call this when done with the workflow, e.g., when creating many workflows in a batch.
+        """
+        atexit.unregister(self.flush)
+        self.flush()
+        atexit.unregister(self.__stop_log_listener)
+        self.__stop_log_listener()
+        self.logger.removeHandler(self.__queue_handler)
+        self.__buffered_filehandler.close()
+        self.__filehandler.close()
 
     def update(
         self, node_name: str, key: str, value: any, save_after=False, append=False
@@ -73,18 +138,16 @@ class ComfyAPIWorkflow:
           key (str): The name of the input field to update.
           value (any): The new value to put in the input field.
           save_after (bool, optional): Whether to save the workflow to the disk after updating.
-            Defaults to False.
+            Saves are debounced, so updates made within SAVE_DEBOUNCE_INTERVAL of each other are
+            written together (call flush() to write right away). Defaults to False.
           append (bool, optional): Whether to append the new value to the existing value.
 
         Raises:
           ValueError: If the node does not exist in the provided template workflow.
           KeyError: If the key does not exist in the workflow node.
         """
-        if node_name in self.__node_titles:
-            index = self.__node_titles[node_name]
-        elif node_name in self.__node_class_types:
-            index = self.__node_class_types[node_name]
-        else:
+        index = self.__node_indices.get(node_name)
+        if index is None:
             raise ValueError(
                 "Project Workflow Error:",
                 f"The node {node_name} does not exist in the provided template workflow",
@@ -96,35 +159,41 @@ class ComfyAPIWorkflow:
                 + "\nThe path is assumed to be the comfy input image directory"
                 + "\n(which should be manually set to whatever folder you need before passing this workflow to a comfy client)\n"
             )
-        if key not in self.workflow_dict[index]["inputs"].keys():
+        inputs = self.workflow_dict[index]["inputs"]
+        if key not in inputs:
             raise KeyError(
                 "Project Workflow Error:",
                 f"The key {key} does not exist in the workflow node {node_name}",
             )
 
-        if self.workflow_dict[index]["inputs"][key] == value:
+        current = inputs[key]
+        if current == value:
             self.logger.warning(
-                f"{node_name}'s {key} value is already set to: {value}",
+                "%s's %s value is already set to: %s", node_name, key, value
             )
             return
 
         if append:
-            self.logger.info(f"{node_name}'s {key} Value Appended with: {value}")
+            self.logger.info("%s's %s Value Appended with: %s", node_name, key, value)
             # Try to add a space between the old and new value
             try:
-                self.workflow_dict[index]["inputs"][key] += " " + value
+                inputs[key] += " " + value
             except TypeError:
-                self.workflow_dict[index]["inputs"][key] += value
+                inputs[key] += value
         else:
             self.logger.info(
-                f"Updating {node_name}'s {key} value: from {self.workflow_dict[index]['inputs'][key]} to {value}"
+                "Updating %s's %s value: from %s to %s", node_name, key, current, value
             )
-            self.workflow_dict[index]["inputs"][key] = value
+            inputs[key] = value
+        self.version += 1
         if save_after:
-            self.save()
+            self.__schedule_save()
 
     def get_workflow_dict(self):
         """
+        The returned dict is the live workflow data, not a copy. If you edit it directly instead of
+        using update(), increment version so clients don't send a stale cached copy.
+
         Returns:
           dict: The workflow dictionary.
         """
@@ -141,19 +210,27 @@ class ComfyAPIWorkflow:
         Returns:
           str: The name of the node or "Unknown".
         """
-        node_index = str(data["node"])
-        try:
-            node_name = self.workflow_dict[node_index]["_meta"]["title"]
-        except KeyError:
-            try:
-                node_name = self.workflow_dict[node_index]["class_type"]
-            except KeyError:
-                self.logger.debug(
-                    f"Could not find the node name for node index {node_index} in the workflow dict"
-                )
-                node_name = "Unknown"
+        node_index = data["node"]
+        node_name = self.__node_names.get(node_index)
+        if node_name is None:
+            self.logger.debug(
+                "Could not find the node name for node index %s in the workflow dict",
+                node_index,
+            )
+            return "Unknown"
         return node_name
 
+    def __schedule_save(self):
+        """
+        Marks the workflow as needing a save and starts a timer to flush it, unless one is pending.
+        """
+        with self.__save_lock:
+            self.__dirty = True
+            if self.__save_timer is None:
+                self.__save_timer = threading.Timer(SAVE_DEBOUNCE_INTERVAL, self.flush)
+                self.__save_timer.daemon = True
+                self.__save_timer.start()
+
     def __set_workflow(self):
         """
         Sets the workflow dictionary by loading the workflow template JSON file.
@@ -162,8 +239,7 @@ class ComfyAPIWorkflow:
           FileNotFoundError: If the workflow template JSON file could not be found at the given path.
         """
         try:
-            with open(self.workflow_template_path, "r") as workflow_file:
-                self.workflow_dict = json.load(workflow_file)
+            self.workflow_dict = orjson.loads(self.workflow_template_path.read_bytes())
         except FileNotFoundError:
             raise FileNotFoundError(
                 f"The passed workflow template json file could not be found at the given path: {self.workflow_template_path}"
@@ -171,22 +247,38 @@ class ComfyAPIWorkflow:
 
     def __set_node_mappings(self):
         """
-        Sets the node mappings for quick access to nodes by title or class_type.
+        Sets the node mapping for quick access to nodes by title or class_type.
+        If a title and a class_type are the same, the node with that title wins.
+
+        Also sets the display name (title, else class_type) of each node index for parse_node_name,
+        keyed by both the str index and, for numeric indices, the int.
         """
-        self.__node_titles = {}
-        self.__node_class_types = {}
+        node_titles = {}
+        node_class_types = {}
+        self.__node_names = {}
 
         for node_index, node in self.workflow_dict.items():
-            if "_meta" in node.keys() and "title" in node["_meta"].keys():
-                self.__node_titles[node["_meta"]["title"]] = node_index
-            if "class_type" in node.keys():
-                self.__node_class_types[node["class_type"]] = node_index
+            title = node.get("_meta", {}).get("title")
+            if title is not None:
+                node_titles[title] = node_index
+            class_type = node.get("class_type")
+            if class_type is not None:
+                node_class_types[class_type] = node_index
+
+            node_name = title if title is not None else class_type
+            if node_name is not None:
+                self.__node_names[node_index] = node_name
+                # Also accept numeric node ids without converting them to str on every lookup
+                if node_index.isdigit():
+                    self.__node_names[int(node_index)] = node_name
+
+        self.__node_indices = {**node_class_types, **node_titles}
 
     def __setup_logging(self):
         self.__logfile_path = (
             (Path(__file__).parent.parent)
             / "logs"
-            / f"comfy_workflow_{time.strftime('%Y-%m-%d_%H:%M:%S')}.log"
+            / f"comfy_workflow_{time.strftime('%Y-%m-%dT%H-%M-%S')}.log"
         )
         self.__logfile_path.parent.mkdir(parents=True, exist_ok=True)
         formatter = logging.Formatter(
@@ -195,10 +287,37 @@ class ComfyAPIWorkflow:
             + "%(message)s",
             datefmt="%H:%M:%S",
         )
-        filehandler = logging.FileHandler(self.__logfile_path)
-        filehandler.setFormatter(formatter)
-        self.logger.addHandler(filehandler)
+        self.__filehandler = logging.FileHandler(self.__logfile_path)
+        self.__filehandler.setFormatter(formatter)
+        # Batch file writes, flushing early only for errors
+        self.__buffered_filehandler = MemoryHandler(
+            capacity=512,
+            flushLevel=logging.ERROR,
+            target=self.__filehandler,
+            flushOnClose=True,
+        )
 
         streamhandler = logging.StreamHandler()
         streamhandler.setFormatter(formatter)
-        self.logger.addHandler(streamhandler)
+
+        # Records are handled by a background thread so logging never blocks on I/O
+        log_queue = queue.SimpleQueue()
+        self.__queue_handler = QueueHandler(log_queue)
+        self.logger.addHandler(self.__queue_handler)
+        self.__log_listener = QueueListener(
+            log_queue, self.__buffered_filehandler, streamhandler
+        )
+        self.__log_listener_running = False
+        self.__start_log_listener()
+        atexit.register(self.__stop_log_listener)
+
+    def __start_log_listener(self):
+        if not self.__log_listener_running:
+            self.__log_listener.start()
+            self.__log_listener_running = True
+
+    def __stop_log_listener(self):
+        if self.__log_listener_running:
+            self.__log_listener.stop()
+            self.__log_listener_running = False
+        self.__buffered_filehandler.flush()